@@ -1,13 +1,21 @@
 # %% Imports
 
-import json
-import os
+import atexit
+import heapq
+import multiprocessing
 import typing as t
+import zlib
+from array import array
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
 
 import numpy as np
+import orjson
 
-from utils import Like, Post, Record, records
+from utils import Follow, Like, Post, Record, records
 
 # Constants
 
@@ -21,8 +29,7 @@ END_DATE = datetime(2023, 3, 1, tzinfo=timezone.utc)
 SESSION_IDLE_THRESHOLD = 30  # minutes
 SESSIONS_PATH = f"./data/sessions-{END_DATE.date()}.jsonl"
 
-if os.path.exists(SESSIONS_PATH):
-    os.remove(SESSIONS_PATH)
+N_SHARDS = 1  # Replay worker processes, each owning a disjoint set of users
 
 
 # %%
@@ -35,9 +42,14 @@ BOTS = ["did:plc:fjsmdevv3mmzc3dpd36u5yxc"]
 
 
 class Users:
-    class Info(t.TypedDict):
-        posts: list[str]
+    @dataclass(slots=True)
+    class Info:
+        posts: deque[tuple[str, str]]  # Most recent (rkey, uri), chronological
+        posts_set: set[str]  # Every post ever logged, for duplicate checks
         following: list[str]
+        following_set: set[str]
+        followers: set[str]
+        following_feed: list[str] | None  # Cached feed, None once a post/follow lands
         last_interaction_ts: int | None
         feed: list[str]
 
@@ -45,7 +57,8 @@ class Users:
         source: FeedType
         posts: list[Post]
 
-    class Session(t.TypedDict):
+    @dataclass(slots=True)
+    class Session:
         """Basic information about a session."""
 
         did: str
@@ -55,25 +68,33 @@ class Users:
         impressions: list[str]
         actions: list[Record]
 
-    def __init__(self) -> None:
+    def __init__(self, sessions_path: str = SESSIONS_PATH) -> None:
         self.info: dict[str, Users.Info] = {}
         self.sessions: dict[str, Users.Session] = {}
 
+        # Sessions are appended as they close, so keep one buffered handle open
+        self._sessions_fp = open(sessions_path, "wb", buffering=1 << 20)
+        atexit.register(self._sessions_fp.close)
+
     def is_bot(self, did: str) -> bool:
         return did in BOTS
 
     def log_user(self, did: str) -> None:
-        self.info[did] = {
-            "following": [],
-            "posts": [],
-            "last_interaction_ts": -1,
-            "feed": [],
-        }
+        self.info[did] = Users.Info(
+            following=[],
+            following_set=set(),
+            followers=set(),
+            following_feed=None,
+            posts=deque(maxlen=MAX_POSTS_PER_USER),
+            posts_set=set(),
+            last_interaction_ts=-1,
+            feed=[],
+        )
 
     def is_new_session(
         self, did: str, now_ts: int, idle_threshold: int = SESSION_IDLE_THRESHOLD
     ) -> bool:
-        last_interaction_ts = self.info[did]["last_interaction_ts"]
+        last_interaction_ts = self.info[did].last_interaction_ts
         if last_interaction_ts is None:
             return True
 
@@ -82,84 +103,85 @@ class Users:
 
     def get_following_feed(self, did: str) -> list:
         """Reconstruct a user's chronolical Following feed at any given time."""
-        feed: list[str] = []
+        info = self.info[did]
 
-        # If user has posted anything:
-        if self.info[did]["posts"]:
-            # Insert most recent K posts into their chron. feed
-            feed.extend(list(self.info[did]["posts"])[-MAX_POSTS_PER_USER:])
+        # Only rebuilt when the user or a followee posted, or the user followed
+        # someone, since the last session
+        if info.following_feed is None:
+            # The user's and each followee's last MAX_POSTS_PER_USER posts
+            feed = chain(info.posts, *(self.info[f].posts for f in info.following))
 
-        # Add posts from followings' timelines
-        for following_did in self.info[did]["following"]:
-            if self.info[following_did]["posts"]:
-                feed.extend(
-                    list(self.info[following_did]["posts"])[-MAX_POSTS_PER_USER:]
-                )
+            # Only the newest posts by rkey (TID) make it into the session
+            newest = heapq.nlargest(MAX_POSTS_PER_SESSION, feed, key=itemgetter(0))
+            info.following_feed = [uri for _, uri in newest]
 
-        return sorted(feed, key=lambda x: x.split("/")[-1], reverse=True)[
-            :MAX_POSTS_PER_SESSION
-        ]
+        # Copied, since the session's impressions are extended in place
+        return list(info.following_feed)
 
     # TODO: Verify, especially number of posts
     def get_profile_feed(self, subject_did: str) -> list:
         """Reconstruct a single user's timeline of posts."""
-        return list(self.info[subject_did]["posts"])[-REFRESH_SIZE:][:REFRESH_SIZE]
+        posts = self.info[subject_did].posts
+        return [uri for _, uri in islice(reversed(posts), REFRESH_SIZE)][::-1]
 
     def log_session(self, did: str, now_ts: int) -> None:
         next_session_num = (
-            self.sessions[did]["session_num"] + 1 if did in self.sessions else 0
+            self.sessions[did].session_num + 1 if did in self.sessions else 0
         )
 
         # Write previous session to disk, if it exists
         if did in self.sessions:
-            with open(SESSIONS_PATH, "a") as f:
-                json.dump(self.sessions[did], f)
-                f.write("\n")
-
-        self.info[did]["feed"] = self.get_following_feed(did)
-        self.sessions[did] = {
-            "session_num": next_session_num,
-            "did": did,
-            "start_ts": now_ts,
-            "end_ts": now_ts,
-            "impressions": self.info[did]["feed"],
-            "actions": [],
-        }
+            self._sessions_fp.write(orjson.dumps(self.sessions[did]) + b"\n")
+
+        self.info[did].feed = self.get_following_feed(did)
+        self.sessions[did] = Users.Session(
+            session_num=next_session_num,
+            did=did,
+            start_ts=now_ts,
+            end_ts=now_ts,
+            impressions=self.info[did].feed,
+            actions=[],
+        )
 
     def dump_sessions(self) -> None:
-        sorted_sessions = sorted(self.sessions.values(), key=lambda x: x["end_ts"])
-        for session in sorted_sessions:
-            with open(SESSIONS_PATH, "a") as f:
-                json.dump(session, f)
-                f.write("\n")
-
-    def get_idx(self, val: str, vals: list[str]) -> int | None:
-        try:
-            idx = vals.index(val)
-        except ValueError:
-            idx = None
-
-        return idx
+        sorted_sessions = sorted(self.sessions.values(), key=attrgetter("end_ts"))
+        self._sessions_fp.writelines(
+            orjson.dumps(session) + b"\n" for session in sorted_sessions
+        )
+        self._sessions_fp.flush()  # Sessions file is read back right after
 
     def log_like(self, did: str, subject_uri: str, record: Like) -> None:
         return
-        # session_id = self.get_session_id(did)
-
-        # Log the record
-        # self.sessions[session_id]["actions"].append(record)
+        # NOTE: The record itself is logged to the session's actions in run()
 
-        # user_feed = self.info[did]["feed"]
+        # user_feed = self.info[did].feed
 
-        # Update seen in following
-        # idx = self.get_idx(subject_uri, user_feed)
-        # if idx:
-        #     self.sessions[session_id]["impressions"] = self.info[did]["feed"][: idx + 1]
+        # Update seen in following. When re-enabled, index the feed's positions
+        # (uri -> i) once per session, on its first like, rather than list.index
+        # idx = feed_pos.get(subject_uri)
+        # if idx is not None:
+        #     self.sessions[did].impressions = user_feed[: idx + 1]
 
-    def log_post(self, did: str, uri: str) -> None:
-        if uri in self.info[did]["posts"]:  # This shouldn't happen, but precaution
+    def log_post(self, did: str, uri: str, rkey: str) -> None:
+        if uri in self.info[did].posts_set:  # This shouldn't happen, but precaution
             print(f"WARNING! Post {uri} already exists for user {did}")
 
-        self.info[did]["posts"].append(uri)
+        post = (rkey, uri)
+        self.info[did].posts.append(post)
+        self.info[did].posts_set.add(uri)
+
+        # The post lands in the author's own feed and their followers' feeds
+        self.info[did].following_feed = None
+        for follower_did in self.info[did].followers:
+            self.info[follower_did].following_feed = None
+
+    def log_remote_post(self, did: str, uri: str, rkey: str) -> None:
+        """Log a post by a user owned by another shard. Only followers' feeds read
+        it here, so skip the author's own feed and duplicate tracking."""
+        info = self.info[did]
+        info.posts.append((rkey, uri))
+        for follower_did in info.followers:
+            self.info[follower_did].following_feed = None
 
     def log_follow(self, did: str, subject_did: str) -> None:
         if subject_did not in self.info:
@@ -170,15 +192,22 @@ class Users:
         # Update session information
         # Start new profile view
 
-        if subject_did in self.info[did]["following"]:
+        if subject_did in self.info[did].following_set:
             return  # This happens semi-frequently, bug in data repos
 
-        self.info[did]["following"].append(subject_did)
-        self.sessions[did]["impressions"].extend(self.get_profile_feed(subject_did))
+        self.info[did].following.append(subject_did)
+        self.info[did].following_set.add(subject_did)
+        self.info[subject_did].followers.add(did)
+
+        self.info[did].following_feed = None
+
+        self.sessions[did].impressions.extend(self.get_profile_feed(subject_did))
 
 
 class Posts:
-    class Info(t.TypedDict):
+    @dataclass(slots=True)
+    class Info:
+        rkey: str
         parent_uri: str | None  # Allows thread reconstruction on-the-fly
         subject_uri: str | None
 
@@ -186,78 +215,178 @@ class Posts:
         self.info: dict[str, Posts.Info] = {}
         self.deleted = set[str]()
 
-    def log_post(self, uri: str) -> None:
-        self.info[uri] = {
-            "parent_uri": None,
-            "subject_uri": None,
-        }
+    def log_post(self, uri: str, rkey: str) -> None:
+        self.info[uri] = Posts.Info(rkey=rkey, parent_uri=None, subject_uri=None)
 
     def log_deleted(self, uri: str) -> None:
         self.deleted.add(uri)
 
 
-users = Users()
-posts = Posts()
+# === Record handlers ===
+
+_POST = "app.bsky.feed.post"
+_LIKE = "app.bsky.feed.like"
+_FOLLOW = "app.bsky.graph.follow"
+
+RecordHandler = t.Callable[[Users, Posts, t.Any, str, int], None]
+
+
+def _handle_post(
+    users: Users, posts: Posts, record: Post, did: str, now_ts: int
+) -> None:
+    # Skip replies and quotes, for now
+    # if "reply" in record or "embed" in record:
+    #     return
+
+    uri = record["uri"]
+    rkey = uri.rsplit("/", 1)[1]  # Split once, reused as the feed sort key
+
+    users.log_post(did, uri, rkey)
+    posts.log_post(uri, rkey)
+
+
+def _handle_like(
+    users: Users, posts: Posts, record: Like, did: str, now_ts: int
+) -> None:
+    if did not in BOTS:
+        users.log_like(did, record["subject"]["uri"], record)
+
+
+def _handle_follow(
+    users: Users, posts: Posts, record: Follow, did: str, now_ts: int
+) -> None:
+    users.log_follow(did, record["subject"])
+
+
+HANDLERS: dict[str, RecordHandler] = {
+    _POST: _handle_post,
+    _LIKE: _handle_like,
+    _FOLLOW: _handle_follow,
+}
+
 
 # === Firehose Iteration ===
 
-# Iterate through each historical record in Bluesky's firehose
-for record in records(IN_DIR, end_date=END_DATE):
-    ts = record["ts"]
-    did = record["did"]
 
-    if did not in users.info:
-        users.log_user(did)
+def shard_of(did: str, n_shards: int) -> int:
+    """Stable (unlike hash()) across worker processes."""
+    return zlib.crc32(did.encode()) % n_shards
 
-    # Session management
-    if did not in BOTS and users.is_new_session(did, ts):
-        users.log_session(did, ts)
 
-    if record["$type"] == "app.bsky.feed.post":
-        # Skip replies and quotes, for now
-        # if "reply" in record or "embed" in record:
-        #     continue
+def shard_sessions_path(shard: int, n_shards: int) -> str:
+    if n_shards == 1:
+        return SESSIONS_PATH
+    return f"./data/sessions-{END_DATE.date()}-shard-{shard}.jsonl"
+
 
-        users.log_post(did, record["uri"])
-        posts.log_post(record["uri"])
+def run(users: Users, posts: Posts, shard: int = 0, n_shards: int = 1) -> None:
+    """Iterate through each historical record in Bluesky's firehose.
 
-    if record["$type"] == "app.bsky.feed.like":
-        if did not in BOTS:
-            users.log_like(did, record["subject"]["uri"], record)
+    With multiple shards, only users owned by `shard` get sessions. Posts from
+    every user are still replayed, since owned users may follow anyone.
+    """
 
-    if record["$type"] == "app.bsky.graph.follow":
-        users.log_follow(did, record["subject"])
+    # Bind hot attributes to locals once, rather than per record
+    info_map = users.info
+    sessions_map = users.sessions
+    log_user = users.log_user
+    is_new_session = users.is_new_session
+    log_session = users.log_session
+    handlers = HANDLERS
+    bots = BOTS
+    sharded = n_shards > 1
 
-    users.info[did]["last_interaction_ts"] = ts
+    for record in records(IN_DIR, end_date=END_DATE):
+        ts = record["ts"]
+        did = record["did"]
 
-    if did not in BOTS:
-        users.sessions[did]["end_ts"] = ts
-        users.sessions[did]["actions"].append(record)
+        if sharded and shard_of(did, n_shards) != shard:
+            if record["$type"] == _POST:
+                if did not in info_map:
+                    log_user(did)
+
+                # Owned users may follow this author, so keep their posts. The
+                # post itself is recorded in Posts by the author's own shard
+                uri = record["uri"]
+                users.log_remote_post(did, uri, uri.rsplit("/", 1)[1])
+            elif record["$type"] == _FOLLOW:
+                # Keep user counts exact for owned users that are only followed
+                subject_did = record["subject"]
+                if shard_of(subject_did, n_shards) == shard:
+                    if subject_did not in info_map:
+                        log_user(subject_did)
+            continue
+
+        is_bot = did in bots
 
-    # TODO: Blocks
+        # Single probe for the common case of an already-known user
+        info = info_map.get(did)
+        if info is None:
+            log_user(did)
+            info = info_map[did]
 
-    # Every time a user starts a new session, they land on their chronological feed screen
-    # So, at the start of each session, we need to gather a user's feed up-to-date chron feed
-    # Based on the actions they take during that session, we can guess how many of the posts
-    #   from their chron feed they've seen, as well as other posts from other screens
-    # If a user likes a post from their chronological feed:
-    #   - Mark all posts until that idx as seen (TODO: Until end of refresh?)
-    # If a user follows a user:
-    #   - Mark the top N posts of that user as seen (TODO: What's N?) or last idx of liked, if liked
-    # If a user replies to a post from their chronological feed, that is a new screen
-    #   - Mark all parent replies in that thread as seen
+        # Session management
+        if not is_bot and is_new_session(did, ts):
+            log_session(did, ts)
 
-    # If they take an action based on that feed, we:
+        handler = handlers.get(record["$type"])
+        if handler:
+            handler(users, posts, record, did, ts)
 
-users.dump_sessions()
+        info.last_interaction_ts = ts
+
+        if not is_bot:
+            session = sessions_map[did]
+            session.end_ts = ts
+            session.actions.append(record)
+
+        # TODO: Blocks
+
+        # Every time a user starts a new session, they land on their chronological feed screen
+        # So, at the start of each session, we need to gather a user's feed up-to-date chron feed
+        # Based on the actions they take during that session, we can guess how many of the posts
+        #   from their chron feed they've seen, as well as other posts from other screens
+        # If a user likes a post from their chronological feed:
+        #   - Mark all posts until that idx as seen (TODO: Until end of refresh?)
+        # If a user follows a user:
+        #   - Mark the top N posts of that user as seen (TODO: What's N?) or last idx of liked, if liked
+        # If a user replies to a post from their chronological feed, that is a new screen
+        #   - Mark all parent replies in that thread as seen
+
+        # If they take an action based on that feed, we:
+
+
+def replay_shard(shard: int) -> tuple[str, int]:
+    """Replay one shard, returning its sessions path and number of owned users."""
+    sessions_path = shard_sessions_path(shard, N_SHARDS)
+    users = Users(sessions_path)
+    posts = Posts()
+
+    run(users, posts, shard, N_SHARDS)
+    users.dump_sessions()
+
+    n_users = sum(1 for did in users.info if shard_of(did, N_SHARDS) == shard)
+    return sessions_path, n_users
+
+
+if N_SHARDS == 1:
+    shard_results = [replay_shard(0)]
+else:
+    # Fork, so workers inherit this module's state without re-running it
+    with multiprocessing.get_context("fork").Pool(N_SHARDS) as pool:
+        shard_results = pool.map(replay_shard, range(N_SHARDS))
+
+sessions_paths = [path for path, _ in shard_results]
+n_users = sum(n for _, n in shard_results)
 
 # %% Validation
 
 
-# Read in sessions file
-with open(SESSIONS_PATH, "r") as f:
-    data = [json.loads(line.strip()) for line in f if line.strip()]
-    sessions = sorted(data, key=lambda x: x["end_ts"])
+# Stream sessions files; aggregate stats don't depend on session order
+def iter_sessions() -> t.Generator[dict[str, t.Any], None, None]:
+    for path in sessions_paths:
+        with open(path, "rb") as f:
+            yield from map(orjson.loads, f)  # Sessions are written one per line
 
 
 # TODO: nRank scoring
@@ -265,10 +394,13 @@ with open(SESSIONS_PATH, "r") as f:
 MIN_INTERACTIONS = 1
 
 interactive_users = set()
-precisions = []
-recalls = []
+precisions = array("f")  # Unboxed float32s; numpy reads them via the buffer protocol
+recalls = array("f")
+n_sessions = 0
+
+for data in iter_sessions():
+    n_sessions += 1
 
-for data in sessions:
     # Number of total interactions
     interactions = [
         record["subject"]["uri"]
@@ -307,12 +439,12 @@ median_precision = np.median(precisions)
 median_recall = np.median(recalls)
 
 print(
-    f"- # sessions: {len(sessions)} "
-    f"(mean: {len(sessions) / len(users.info):.1f} sessions/user)"
+    f"- # sessions: {n_sessions} "
+    f"(mean: {n_sessions / n_users:.1f} sessions/user)"
 )
 print(
-    f"- # interactive users: {len(interactive_users)}/{len(users.info)} "
-    f"({len(interactive_users) / len(users.info):.4f}%)"
+    f"- # interactive users: {len(interactive_users)}/{n_users} "
+    f"({len(interactive_users) / n_users:.4f}%)"
 )
 print(
     f"- Mean Precision: {mean_precision:.4f} (variance: {var_precision:.4f}), Median: {median_precision:.4f}"
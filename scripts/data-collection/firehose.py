@@ -1,44 +1,84 @@
 import asyncio
-import json
+import logging
+import sys
 from datetime import datetime
 
+import orjson
 import websockets
 
+logger = logging.getLogger(__name__)
 
-async def connect_firehose():
-    """Connect to the Bluesky firehose websocket stream"""
+
+def log_frame(message: str | bytes) -> None:
+    """Parse and pretty-print a frame to the debug log. Run off the event loop."""
+    try:
+        data = orjson.loads(message)
+    except orjson.JSONDecodeError:
+        logger.debug(f"Error: {message[:50]!r}... is not valid JSON")
+        return
+
+    logger.debug(orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
+
+
+async def connect_firehose(archive_path: str | None = None):
+    """Connect to the Bluesky firehose websocket stream. Raw frames are written
+    to `archive_path`, or stdout if unset, one JSON object per line."""
     uri = "wss://jetstream2.us-east.bsky.network/subscribe"
 
     async with websockets.connect(uri) as websocket:
-        print(f"Connected to firehose at {datetime.now()}")
+        logger.info(f"Connected to firehose at {datetime.now()}")
+
+        archive = open(archive_path, "ab") if archive_path else sys.stdout.buffer
+        debug = logger.isEnabledFor(logging.DEBUG)
 
         try:
             while True:
                 message = await websocket.recv()
-                try:
-                    # Message is already bytes, don't decode
-                    data = json.loads(message)
-                except UnicodeDecodeError:
-                    print(f"Error: {message[:50]}... is not valid UTF-8")
-                    continue
 
-                print(json.dumps(data, indent=2))
+                # Frames are already valid JSON, so write them as-is
+                frame = message.encode() if isinstance(message, str) else message
+                archive.write(frame + b"\n")
+
+                # Only pay for parsing and pretty-printing when debugging, and do
+                # all of it off the event loop so the socket keeps draining
+                if debug:
+                    await asyncio.to_thread(log_frame, message)
 
         except websockets.exceptions.ConnectionClosed:
-            print("Connection closed, attempting to reconnect...")
+            logger.info("Connection closed, attempting to reconnect...")
         except Exception as e:
-            print(f"Error: {e}")
+            logger.error(f"Error: {e}")
+        finally:
+            if archive_path:
+                archive.close()
+            else:
+                archive.flush()
 
 
-async def main():
+async def main(archive_path: str | None = None):
     while True:
         try:
-            await connect_firehose()
+            await connect_firehose(archive_path)
         except Exception as e:
-            print(f"Connection failed: {e}")
-            print("Retrying in 5 seconds...")
+            logger.error(f"Connection failed: {e}")
+            logger.error("Retrying in 5 seconds...")
             await asyncio.sleep(5)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--archive", help="Append raw frames to this file instead of stdout"
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Log every frame, pretty-printed"
+    )
+    args = parser.parse_args()
+
+    # Logs go to stderr, so stdout stays a clean stream of frames
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO, format="%(message)s"
+    )
+    asyncio.run(main(args.archive))
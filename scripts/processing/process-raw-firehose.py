@@ -20,19 +20,28 @@
 
 # ==== Imports ====
 
+import calendar
 import datetime
-import heapq
-import json
+import math
+import multiprocessing
 import os
+import pickle
 import shutil
+import typing as t
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, islice
+from operator import itemgetter
 from pathlib import Path
 
+import orjson
+
 from utils import (
     Record,
     did_from_uri,
     get_quoted_uri,
+    numbered_files,
     parse_rkey,
-    records,
     rkey_from_uri,
 )
 
@@ -44,6 +53,10 @@ BATCH_SIZE = 1_000_000  # Number of records per file
 IN_DIR = "./data/stream-2023-07-01"
 TEMP_DIR = f"./data/firehose-temp-{END_DATE.date()}"
 OUT_DIR = f"./data/firehose-{END_DATE.date()}"
+SLIM_DIR = f"{TEMP_DIR}/slim"  # Per-batch records trimmed to what detection reads
+PICKLE_CHUNK_SIZE = 10_000  # Records per pickled chunk in temp files
+N_WORKERS = os.cpu_count() or 1  # Processes sorting daily input files in parallel
+OUT_BUF_SIZE = 64 << 20  # Bytes of serialized output buffered per write
 
 # ==== Directory cleanup ====
 
@@ -55,20 +68,75 @@ if os.path.exists(OUT_DIR):
 
 # Recreate directories
 os.makedirs(TEMP_DIR)
+os.makedirs(SLIM_DIR)
 os.makedirs(OUT_DIR)
 
 
 # ==== Helper functions ====
 
 
+def _fast_iso_ms(s: str) -> int | None:
+    """Parse the usual "YYYY-MM-DDTHH:MM:SS[.fff]Z" createdAt shape to Unix ms.
+    Returns None for any other shape, to fall back to fromisoformat."""
+    if len(s) == 24:
+        if s[19] != ".":
+            return None
+    elif len(s) != 20:
+        return None
+
+    if s[4] != "-" or s[7] != "-" or s[10] != "T" or s[13] != ":" or s[16] != ":":
+        return None
+    if s[-1] != "Z":
+        return None
+
+    # int() would also take signs, spaces and underscores, so require digits
+    digits = s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19] + s[20:23]
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+
+    year, month, day = int(s[0:4]), int(s[5:7]), int(s[8:10])
+    hour, minute, second = int(s[11:13]), int(s[14:16]), int(s[17:19])
+    ms = int(s[20:23]) if len(s) == 24 else 0
+
+    # timegm rolls out-of-range fields over (Feb 30 -> Mar 2) instead of failing
+    if not (
+        year >= 1
+        and 1 <= month <= 12
+        and 1 <= day <= calendar.monthrange(year, month)[1]
+        and hour <= 23
+        and minute <= 59
+        and second <= 59
+    ):
+        return None
+
+    date_time = (year, month, day, hour, minute, second)
+    # Same float arithmetic as datetime.timestamp() * 1_000, truncation included
+    micros = calendar.timegm(date_time) * 1_000_000 + ms * 1_000
+    return int(micros / 1_000_000 * 1_000)
+
+
+# Last parsed profile createdAt, since consecutive records often repeat it
+_last_created_at: str | None = None
+_last_created_ts = 0
+
+
 def calc_timestamp(record: Record) -> int | None:
+    global _last_created_at, _last_created_ts
+
     if record["$type"] == "app.bsky.actor.profile":
-        ts = int(
-            datetime.datetime.fromisoformat(
-                record["createdAt"].replace("Z", "+00:00")
-            ).timestamp()
-            * 1_000
-        )
+        created_at = record["createdAt"]
+        if created_at == _last_created_at:
+            return _last_created_ts
+
+        ts = _fast_iso_ms(created_at)
+        if ts is None:
+            ts = int(
+                datetime.datetime.fromisoformat(
+                    created_at.replace("Z", "+00:00")
+                ).timestamp()
+                * 1_000
+            )
+        _last_created_at, _last_created_ts = created_at, ts
 
     else:
         rkey = rkey_from_uri(record["uri"])
@@ -80,156 +148,339 @@ def calc_timestamp(record: Record) -> int | None:
     return ts
 
 
-# ==== RE-ORDER RECORDS BASED ON RKEY ====
+def dump_chunks(records: t.Iterable[t.Any], path: str) -> None:
+    """Write records to a temp file as a sequence of pickled lists. Pickle
+    round-trips these small dicts much faster than JSON, and chunking keeps
+    reads streaming instead of loading the whole file."""
+    it = iter(records)
+    with open(path, "wb") as outf:
+        while chunk := list(islice(it, PICKLE_CHUNK_SIZE)):
+            pickle.dump(chunk, outf, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-stream_dir = Path(IN_DIR)
-files = sorted(stream_dir.glob("*.jsonl"))
-record_buffer: list[tuple[int, int, Record]] = []
-end_ts = END_DATE.timestamp() * 1_000  # Milliseconds
+def iter_pickled(path: str | Path) -> t.Generator[t.Any, None, None]:
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
 
-counter = 0  # For heap tie-breaker
-total_records = 0
-file_counter = 0
 
-for file in files:
-    file_date = datetime.datetime.strptime(file.stem, "%Y-%m-%d").date()
-    if file_date >= END_DATE.date():
-        break
+# Reused across output batches, so flushing never allocates a new buffer
+_out_buf = bytearray(OUT_BUF_SIZE)
 
-    with open(file) as f:
-        for line in f:
-            record: Record = json.loads(line)
 
-            ts = calc_timestamp(record)
+def _write_all(fd: int, data: memoryview) -> None:
+    while data:
+        data = data[os.write(fd, data) :]
 
-            # Invalid rkey, or TS is past END_DATE
-            if ts is None or ts >= end_ts:
-                continue
 
-            record_with_ts: Record = {"ts": ts, **record}  # type: ignore
-
-            # Add to heap, sorted by ts
-            heapq.heappush(record_buffer, (ts, counter, record_with_ts))
-            counter += 1
-
-            # If buffer is full, write out the smallest N records
-            if len(record_buffer) >= BATCH_SIZE * 2:
-                with open(f"{TEMP_DIR}/{file_counter}.json", "w") as outf:
-                    smallest_n = []
-                    for _ in range(BATCH_SIZE):
-                        if record_buffer:
-                            _, _, record = heapq.heappop(record_buffer)
-                            smallest_n.append(record)
-                            total_records += 1
-                    json.dump({"records": smallest_n}, outf)
-                file_counter += 1
-
-# Write remaining records
-while record_buffer:
-    batch = []
-    while record_buffer and len(batch) < BATCH_SIZE:
-        _, _, record = heapq.heappop(record_buffer)
-        batch.append(record)
-        total_records += 1
-
-    if batch:
-        with open(f"{TEMP_DIR}/{file_counter}.json", "w") as outf:
-            json.dump({"records": batch}, outf)
-        file_counter += 1
+def write_ndjson(records: t.Iterable[t.Any], path: str) -> None:
+    """Serialize records into the shared output buffer, one JSON object per line,
+    and write it out whenever it fills."""
+    buf = _out_buf
+    offset = 0
 
+    with open(path, "wb", buffering=0) as outf, memoryview(buf) as view:
+        fd = outf.fileno()
+        for record in records:
+            line = orjson.dumps(record)
+            end = offset + len(line)
 
-# ==== IDENTIFY DELETED POSTS AND USERS ====
+            if end >= OUT_BUF_SIZE:
+                _write_all(fd, view[:offset])
+                offset, end = 0, len(line)
+                if end >= OUT_BUF_SIZE:  # Larger than the buffer on its own
+                    _write_all(fd, memoryview(line + b"\n"))
+                    continue
+
+            buf[offset:end] = line
+            buf[end] = 0x0A  # Newline
+            offset = end + 1
+
+        _write_all(fd, view[:offset])
+
+
+def write_run(run: list[Record], run_name: str) -> str:
+    """Sort a run by ts (stable, so ties keep stream order) and write it out.
+    Timsort is close to linear on a day's already near-sorted records."""
+    run.sort(key=itemgetter("ts"))
+
+    path = f"{TEMP_DIR}/run_{run_name}.pkl"
+    dump_chunks(run, path)
+
+    return path
+
+
+def merge_runs(paths: list[str]) -> t.Generator[list[Record], None, None]:
+    """K-way merge of sorted runs by ts, a sorted block at a time.
+
+    Each run buffers its pickled chunks. Every record below the smallest buffered
+    tail ts is final, so those are cut from each buffer, concatenated in run
+    order, and stable-sorted at once. Timsort merges the presorted pieces in C,
+    rather than a heap operation per record. Ties keep run order, as with
+    heapq.merge, since a ts is only emitted once every run is past it.
+    """
+    get_ts = itemgetter("ts")
+    chunks = [iter_pickled(path) for path in paths]
+    bufs: list[list[Record]] = [[] for _ in paths]
+    done = [False] * len(paths)
+
+    def refill(i: int) -> None:
+        chunk = next(chunks[i], None)
+        if chunk is None:
+            done[i] = True
+        else:
+            bufs[i] += chunk
+
+    for i in range(len(paths)):
+        refill(i)
 
-users = set[str]()
-posts = set[str]()
-deleted_users = set[str]()
-deleted_posts = set[str]()
+    while True:
+        # Every record a run has yet to yield is at or above its frontier
+        fronts = [
+            math.inf if done[i] else get_ts(buf[-1]) for i, buf in enumerate(bufs)
+        ]
+        cutoff = min(fronts, default=math.inf)
 
-# Iterate through each historical record in Bluesky's firehose
-for record in records(TEMP_DIR, end_date=END_DATE):
-    users.add(record["did"])
+        block: list[Record] = []
+        for buf in bufs:
+            end = bisect_left(buf, cutoff, key=get_ts)
+            block += buf[:end]
+            del buf[:end]
+
+        block.sort(key=get_ts)
+        if block:
+            yield block
 
-    match record["$type"]:
-        case "app.bsky.feed.post":
-            # if record["uri"] == inspected_uri:
-            #     print("FOUND OG: ", record)
+        if cutoff == math.inf:
+            return
+
+        for i, front in enumerate(fronts):
+            if front == cutoff:
+                refill(i)
 
-            posts.add(record["uri"])
 
-            # If a user replied to a post, we know that user saw all parent posts in that thread
-            if "reply" in record and record["reply"]:
-                root_uri = record["reply"]["root"]["uri"]
-                parent_uri = record["reply"]["parent"]["uri"]
+def iter_batches(
+    blocks: t.Iterable[list[Record]],
+) -> t.Generator[list[Record], None, None]:
+    """Re-cut merged blocks into batches of BATCH_SIZE records."""
+    pending: list[Record] = []
+
+    for block in blocks:
+        pending += block
+
+        start = 0
+        while len(pending) - start >= BATCH_SIZE:
+            yield pending[start : start + BATCH_SIZE]
+            start += BATCH_SIZE
+
+        del pending[:start]
+
+    if pending:
+        yield pending
+
+
+class SlimChunk(t.TypedDict):
+    """Columns of what deletion detection reads from a chunk of records. Indexes
+    are positions within the chunk, to keep stream order."""
+
+    dids: list[str]  # Author of every record
+    post_idxs: list[int]
+    post_uris: list[str]
+    ref_idxs: list[int]  # Reply root/parent, quote, and like/repost subjects
+    ref_uris: list[str]
+    follow_idxs: list[int]
+    follow_dids: list[str]
 
-                # if root_uri == inspected_uri:
-                #     print("FOUND IN ROOT: ", record)
 
-                # if parent_uri == inspected_uri:
-                #     print("FOUND IN PARENT: ", record)
+def slim_chunk(chunk: list[Record]) -> SlimChunk:
+    slim = SlimChunk(
+        dids=[],
+        post_idxs=[],
+        post_uris=[],
+        ref_idxs=[],
+        ref_uris=[],
+        follow_idxs=[],
+        follow_dids=[],
+    )
+
+    for idx, record in enumerate(chunk):
+        slim["dids"].append(record["did"])
+
+        match record["$type"]:
+            case "app.bsky.feed.post":
+                slim["post_idxs"].append(idx)
+                slim["post_uris"].append(record["uri"])
+
+                # If a user replied to a post, we know that user saw all parent
+                # posts in that thread. If a user quoted a post, they saw the
+                # subject post
+                refs = []
+                if "reply" in record and record["reply"]:
+                    refs.append(record["reply"]["root"]["uri"])
+                    refs.append(record["reply"]["parent"]["uri"])
+                refs.append(get_quoted_uri(record))
+
+                for uri in refs:
+                    if uri:  # Hacky, for one-off case
+                        slim["ref_idxs"].append(idx)
+                        slim["ref_uris"].append(uri)
+
+            case "app.bsky.graph.follow":
+                slim["follow_idxs"].append(idx)
+                slim["follow_dids"].append(record["subject"])
+
+            case "app.bsky.feed.like" | "app.bsky.feed.repost":
+                slim["ref_idxs"].append(idx)
+                slim["ref_uris"].append(record["subject"]["uri"])
+
+    return slim
+
 
-                if root_uri:  # Hacky, for one-off case
-                    if root_uri not in posts:
-                        deleted_posts.add(root_uri)
+def dump_slim(batch: list[Record], path: str) -> None:
+    with open(path, "wb") as outf:
+        for start in range(0, len(batch), PICKLE_CHUNK_SIZE):
+            chunk = batch[start : start + PICKLE_CHUNK_SIZE]
+            pickle.dump(slim_chunk(chunk), outf, protocol=pickle.HIGHEST_PROTOCOL)
 
-                    root_did = did_from_uri(root_uri)
-                    if root_did not in users:
-                        deleted_users.add(root_did)
 
-                if parent_uri:  # Hacky, for one-off case
-                    if parent_uri not in posts:
-                        deleted_posts.add(parent_uri)
+def iter_slim() -> t.Generator[SlimChunk, None, None]:
+    for file in numbered_files(SLIM_DIR, ".pkl"):
+        yield from iter_pickled(file)
 
-                    parent_did = did_from_uri(parent_uri)
-                    if parent_did not in users:
-                        deleted_users.add(parent_did)
 
-            # If a user quoted a post, we know they saw the subject post
-            quoted_uri = get_quoted_uri(record)
-            if quoted_uri:
-                # if quoted_uri == inspected_uri:
-                #     print("FOUND IN QUOTE: ", record)
+# ==== RE-ORDER RECORDS BASED ON RKEY ====
 
-                if quoted_uri not in posts:
-                    deleted_posts.add(quoted_uri)
+# External merge sort: input is already split by day and near-sorted within
+# each day, so each day becomes one sorted run, then runs are k-way merged
 
-                quoted_did = did_from_uri(quoted_uri)
-                if quoted_did not in users:
-                    deleted_users.add(quoted_did)
+stream_dir = Path(IN_DIR)
+end_ts = END_DATE.timestamp() * 1_000  # Milliseconds
 
-        case "app.bsky.graph.follow":
-            if record["subject"] not in users:
-                # Probably a deleted user? Maybe a bug?
-                deleted_users.add(record["subject"])
+files = [
+    file
+    for file in sorted(stream_dir.glob("*.jsonl"))
+    if datetime.datetime.strptime(file.stem, "%Y-%m-%d").date() < END_DATE.date()
+]
 
-        case "app.bsky.feed.like":
-            subject_uri = record["subject"]["uri"]
 
-            # if subject_uri == inspected_uri:
-            #     print("FOUND IN LIKE: ", record)
+def process_day(path: Path) -> str | None:
+    """Timestamp one day's records and write them out as a sorted run.
+    Returns the run's path, or None if no record in the day is kept."""
+    run: list[Record] = []
 
-            if subject_uri not in posts:
-                deleted_posts.add(subject_uri)
+    with open(path, "rb") as f:
+        for line in f:
+            record: Record = orjson.loads(line)
 
-            subect_did = did_from_uri(subject_uri)
-            if subect_did not in users:
-                deleted_users.add(subect_did)
+            ts = calc_timestamp(record)
 
-        case "app.bsky.feed.repost":
-            subject_uri = record["subject"]["uri"]
+            # Invalid rkey, or TS is past END_DATE
+            if ts is None or ts >= end_ts:
+                continue
 
-            # if subject_uri == inspected_uri:
-            #     print("FOUND IN REPOST: ", record)
+            # Set on the freshly parsed dict rather than copying it into a new one
+            record["ts"] = ts
+            run.append(record)
 
-            if subject_uri not in posts:
-                deleted_posts.add(subject_uri)
+    if not run:
+        return None
+    return write_run(run, path.stem)
 
-            subect_did = did_from_uri(subject_uri)
-            if subect_did not in users:
-                deleted_users.add(subect_did)
 
-        case _:
-            continue
+# Days are independent until the merge. Forked workers inherit the module state
+# above rather than re-running this script on import
+with ProcessPoolExecutor(
+    max_workers=N_WORKERS, mp_context=multiprocessing.get_context("fork")
+) as executor:
+    run_paths = [p for p in executor.map(process_day, files) if p is not None]
+
+# Merge runs into batches of BATCH_SIZE records, keeping only the slim form for
+# detection. Full records are merged again from the runs during re-insertion
+total_records = 0
+file_counter = 0
+
+for batch in iter_batches(merge_runs(run_paths)):
+    dump_slim(batch, f"{SLIM_DIR}/{file_counter}.pkl")
+
+    total_records += len(batch)
+    file_counter += 1
+
+
+# ==== IDENTIFY DELETED POSTS AND USERS ====
+
+def find_missing(
+    ref_keys: list[t.Any],
+    ref_idxs: list[int],
+    seen: set[t.Any],
+    chunk_keys: list[t.Any],
+    chunk_idxs: t.Sequence[int],
+) -> t.Iterator[int]:
+    """Yield positions in `ref_keys` of references to keys neither in `seen` nor
+    added by the chunk at or before the referencing record.
+
+    The set difference against `seen` runs in C and usually leaves nothing, so
+    per-reference Python work is limited to the few keys first seen in the chunk.
+    """
+    missing = set(ref_keys).difference(seen)
+    if not missing:
+        return
+
+    # Later duplicates are overwritten by earlier ones, keeping first positions
+    first_idx = dict(zip(reversed(chunk_keys), reversed(chunk_idxs)))
+
+    for i in compress(range(len(ref_keys)), map(missing.__contains__, ref_keys)):
+        first = first_idx.get(ref_keys[i])
+        if first is None or first > ref_idxs[i]:
+            yield i
+
+
+def scan(
+    chunks: t.Iterable[SlimChunk],
+) -> tuple[set[int], set[str], set[str], set[str]]:
+    """Scan the firehose one slim chunk at a time, with bulk set operations per
+    chunk. Returns (posts, users, deleted_posts, deleted_users).
+
+    Kept in a function so the per-chunk work reads fast locals, not globals.
+    """
+    users = set[str]()
+    # Seen posts are kept as 64-bit str hashes rather than the URIs themselves: a
+    # compact membership filter with a negligible false positive rate, avoiding
+    # a resident ~70-char string per post. Deleted posts keep their full URIs
+    posts = set[int]()
+    deleted_users = set[str]()
+    deleted_posts = set[str]()
+
+    for chunk in chunks:
+        dids = chunk["dids"]
+        post_hashes = list(map(hash, chunk["post_uris"]))
+        ref_uris = chunk["ref_uris"]
+        ref_idxs = chunk["ref_idxs"]
+
+        # Referenced posts that were never posted
+        ref_hashes = list(map(hash, ref_uris))
+        missing_posts = find_missing(
+            ref_hashes, ref_idxs, posts, post_hashes, chunk["post_idxs"]
+        )
+        deleted_posts.update(map(ref_uris.__getitem__, missing_posts))
+
+        # Referenced users (post authors and follow subjects) that never acted
+        user_refs = list(map(did_from_uri, ref_uris)) + chunk["follow_dids"]
+        user_ref_idxs = ref_idxs + chunk["follow_idxs"]
+        missing_users = find_missing(
+            user_refs, user_ref_idxs, users, dids, range(len(dids))
+        )
+        deleted_users.update(map(user_refs.__getitem__, missing_users))
+
+        posts.update(post_hashes)
+        users.update(dids)
+
+    return posts, users, deleted_posts, deleted_users
+
+
+posts, users, deleted_posts, deleted_users = scan(iter_slim())
 
 # ==== VALIDATION ====
 
@@ -242,7 +493,7 @@ if user_overlap:
     print(user_overlap)
 
 # Check for any posts that are marked as both existing and deleted
-post_overlap = deleted_posts.intersection(set(posts))
+post_overlap = {uri for uri in deleted_posts if hash(uri) in posts}
 if post_overlap:
     print(
         f"\nWarning: Found {len(post_overlap)} posts that are both deleted and existing:"
@@ -258,58 +509,53 @@ print(f"\nDeletion rate: {deletion_rate:.2f}% of all posts")
 
 # ==== DELETE RE-INSERTION ====
 
-# Filter out invalid rkeys from deleted posts
-valid_deletes: list[str] = []
+# Filter out invalid rkeys from deleted posts, decoding each rkey and DID once
+valid_deletes: list[tuple[str, int, str, str]] = []  # (rkey, ts, did, uri)
 for uri in deleted_posts:
     rkey = rkey_from_uri(uri)
     if rkey:
-        parse_rkey(rkey)
-        valid_deletes.append(uri)
+        ts, _ = parse_rkey(rkey)
+        valid_deletes.append((rkey, ts, did_from_uri(uri), uri))
 
-# Sort deletes
-sorted_deletes = sorted(valid_deletes, key=lambda x: x.split("/")[-1])
+# Sort deletes by rkey
+sorted_deletes = sorted(valid_deletes)
 
 delete_ts = -1
 delete_idx = 0
 last_ts = -1
 
-stream_dir = Path(TEMP_DIR)
-files = sorted(stream_dir.glob("*.json"), key=lambda x: int(x.stem))
-
-# Insert deleted posts into firehose
-for file in files:
+# Insert deleted posts into firehose, writing each merged batch straight out
+for batch_idx, batch in enumerate(iter_batches(merge_runs(run_paths))):
     new_batch = []
 
-    with open(file) as f:
-        data: list[Record] = json.load(f)["records"]
-        for record in data:
-            ts = record["ts"]
-
-            # If deleted record TS in between last and current, insert
-            while (
-                delete_idx < len(sorted_deletes)
-                and delete_ts >= last_ts
-                and delete_ts <= ts
-            ):
-                new_batch.append(
-                    {
-                        "$type": "app.bsky.feed.post",
-                        "ts": ts,
-                        "did": did_from_uri(sorted_deletes[delete_idx]),
-                        "uri": sorted_deletes[delete_idx],
-                        "deleted": True,
-                    }
-                )
-                delete_idx += 1
-                if delete_idx < len(sorted_deletes):
-                    delete_ts, _ = parse_rkey(rkey_from_uri(sorted_deletes[delete_idx]))  # type: ignore
-
-            new_batch.append(record)
-            last_ts = ts
-
-    with open(f"{OUT_DIR}/{file.name}", "w") as outf:
-        print(f"New batch length: {len(new_batch)}")
-        json.dump({"records": new_batch}, outf)
+    for record in batch:
+        ts = record["ts"]
+
+        # If deleted record TS in between last and current, insert
+        while (
+            delete_idx < len(sorted_deletes)
+            and delete_ts >= last_ts
+            and delete_ts <= ts
+        ):
+            _, _, deleted_did, deleted_uri = sorted_deletes[delete_idx]
+            new_batch.append(
+                {
+                    "$type": "app.bsky.feed.post",
+                    "ts": ts,
+                    "did": deleted_did,
+                    "uri": deleted_uri,
+                    "deleted": True,
+                }
+            )
+            delete_idx += 1
+            if delete_idx < len(sorted_deletes):
+                delete_ts = sorted_deletes[delete_idx][1]
+
+        new_batch.append(record)
+        last_ts = ts
+
+    print(f"New batch length: {len(new_batch)}")
+    write_ndjson(new_batch, f"{OUT_DIR}/{batch_idx}.jsonl")
 
 
 # Clean up temp directory
@@ -1,9 +1,10 @@
 import mmap
-from pathlib import Path
+import os
+import sys
 import typing as t
 from datetime import datetime
 
-import ujson as json
+import orjson
 from tqdm import tqdm
 
 T = t.TypeVar("T")
@@ -15,14 +16,46 @@ class jsonl[T]:
     @classmethod
     def iter(cls, path: str) -> t.Generator[T, None, None]:
         with open(path, "rb") as f:
+            if not f.seek(0, 2):
+                return  # mmap can't map an empty file
+
             with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
                 for line in iter(mm.readline, b""):
                     try:
-                        yield json.loads(line)
-                    except json.JSONDecodeError:
+                        yield orjson.loads(line)
+                    except orjson.JSONDecodeError:
                         print(f"JSONDecodeError: {line}")
                         continue
 
+    @classmethod
+    def last(cls, path: str) -> T | None:
+        """Parse only the final line of the file, without reading the rest.
+        Returns None if the file is empty or that line is not valid JSON."""
+        with open(path, "rb") as f:
+            if not f.seek(0, 2):
+                return None  # mmap can't map an empty file
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = len(mm) - 1 if mm[-1:] == b"\n" else len(mm)
+                start = mm.rfind(b"\n", 0, end) + 1
+                if end <= start:
+                    return None
+
+                try:
+                    return orjson.loads(mm[start:end])
+                except orjson.JSONDecodeError:
+                    return None  # Skipped by iter() too
+
+
+def numbered_files(dir_path: str, ext: str = ".jsonl") -> list[str]:
+    """Paths of the batch files named `<n><ext>` in a directory, in batch order.
+    One os.scandir pass, sorting bare names instead of Path objects."""
+    with os.scandir(dir_path) as it:
+        names = [e.name for e in it if e.name.endswith(ext) and e.is_file()]
+
+    names.sort(key=lambda name: int(name[: -len(ext)]))
+    return [os.path.join(dir_path, name) for name in names]
+
 
 def records(
     stream_path: str, end_date: datetime | None = None, batch_size: int = 1_000_000
@@ -33,16 +66,28 @@ def records(
     End date is not incluive.
     """
 
-    path = Path(stream_path)
-    files = sorted(path.glob("*.json"), key=lambda x: int(x.stem))
+    files = numbered_files(stream_path)
+
+    # Records carry integer ms timestamps, so compare against an int cutoff
+    end_ts = int(end_date.timestamp() * 1_000) if end_date else None
 
     for fname in tqdm(files, total=len(files)):
-        with open(fname, "r") as f:
-            records: list[Record] = json.load(f)["records"]
-            for record in records:
-                if end_date and record["ts"] > end_date.timestamp() * 1000:
-                    return
-                yield record
+        # Batches are sorted by ts, so only the one crossing end_date needs
+        # per-record checks, and every other record can skip them
+        past_end = False
+        if end_ts is not None:
+            last = jsonl[Record].last(fname)
+            past_end = last is not None and last["ts"] > end_ts
+
+        for record in jsonl[Record].iter(fname):
+            if past_end and record["ts"] > end_ts:  # type: ignore
+                return
+
+            # Intern the small set of types, and DIDs, so downstream dict
+            # lookups and comparisons can short-circuit on identity
+            record["$type"] = sys.intern(record["$type"])
+            record["did"] = sys.intern(record["did"])
+            yield record
 
 
 # === Data types ===
@@ -157,9 +202,10 @@ def get_quoted_uri(post: Post) -> t.Optional[str]:
 
 
 def rkey_from_uri(uri: str) -> str | None:
-    rkey = uri.split("/")[-1]
+    rkey = uri.rsplit("/", 1)[-1]
 
-    if not isinstance(rkey, str) or not rkey.isalnum() or len(rkey) != 13:
+    # TIDs are exactly 13 base32-sortable characters
+    if len(rkey) != 13 or rkey.strip(S32_CHAR):
         return None
 
     return rkey
@@ -167,10 +213,27 @@ def rkey_from_uri(uri: str) -> str | None:
 
 def parse_rkey(rev: str) -> tuple[int, int]:
     """Extract the data from the rkey of a URI. Returns (timestamp, clock_id) tuple.
-    timestamp is Unix timestamp in microseconds."""
-
-    timestamp = s32.decode(rev[:-2]) // 1000  # unix, milliseconds
-    clock_id = s32.decode(rev[-2:])
+    timestamp is Unix timestamp in microseconds. rev must be a valid 13-char TID."""
+
+    b = rev.encode("ascii")
+    lut = _S32_LUT
+
+    # Unrolled s32 decode of the 11 timestamp and 2 clock ID characters
+    micros = (
+        lut[b[0]] << 50
+        | lut[b[1]] << 45
+        | lut[b[2]] << 40
+        | lut[b[3]] << 35
+        | lut[b[4]] << 30
+        | lut[b[5]] << 25
+        | lut[b[6]] << 20
+        | lut[b[7]] << 15
+        | lut[b[8]] << 10
+        | lut[b[9]] << 5
+        | lut[b[10]]
+    )
+    timestamp = micros // 1000  # unix, milliseconds
+    clock_id = lut[b[11]] << 5 | lut[b[12]]
 
     return timestamp, clock_id
 
@@ -180,26 +243,32 @@ def did_from_uri(uri: str) -> str:
         raise ValueError("\nMisformatted URI (empty string)")
 
     try:
-        return uri.split("/")[2]
+        # Interned, since the same DIDs recur across millions of URIs
+        return sys.intern(uri.split("/", 3)[2])
     except Exception:
         raise ValueError(f"\nMisformatted URI: {uri}")
 
 
-class s32:
-    S32_CHAR = "234567abcdefghijklmnopqrstuvwxyz"
+S32_CHAR = "234567abcdefghijklmnopqrstuvwxyz"
+_S32_BYTES = S32_CHAR.encode("ascii")
 
-    @classmethod
-    def encode(cls, i: int) -> str:
-        s = ""
-        while i:
-            c = i % 32
-            i = i // 32
-            s = s32.S32_CHAR[c] + s
-        return s
+# Byte -> s32 digit, so decoding is an index rather than a scan of S32_CHAR
+_S32_LUT = bytearray(256)
+for _i, _c in enumerate(_S32_BYTES):
+    _S32_LUT[_c] = _i
 
-    @classmethod
-    def decode(cls, s: str) -> int:
-        i = 0
-        for c in s:
-            i = i * 32 + s32.S32_CHAR.index(c)
-        return i
+
+def s32_encode(i: int) -> str:
+    buf = bytearray()
+    while i:
+        buf.append(_S32_BYTES[i & 31])
+        i >>= 5
+    buf.reverse()
+    return buf.decode("ascii")
+
+
+def s32_decode(s: str) -> int:
+    i = 0
+    for c in s.encode("ascii"):
+        i = i << 5 | _S32_LUT[c]
+    return i